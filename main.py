@@ -1,7 +1,11 @@
 import sys, rearrange
 
 def main():
-    rearrange.readSamFile(sys.argv[1], sys.argv[2], sys.argv[3])
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1 # default: no worker pool
+    if sys.argv[1].endswith('.bam'):
+        rearrange.readBamFile(sys.argv[1], sys.argv[2], sys.argv[3], processes)
+    else:
+        rearrange.readSamFile(sys.argv[1], sys.argv[2], sys.argv[3], processes)
     print('SAM file filtering and rearrangement complete.')
 
 if __name__ == "__main__":
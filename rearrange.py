@@ -12,10 +12,40 @@ Therefore, the function of this script:
 - identify both mate pairs reads and write them in adjacent rows in output.
 - if any 'paired' reads are present without their mate, then exclude from output. Thus, ensure that
 for each alignment (or multi-mapping alignments) there are an even number of reads/rows present.
-
-* Note, to ensure script runs correctly be sure there are >= 2 empty rows at end of input SAM file.
 """
 
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from operator import itemgetter
+
+QUEUE_SIZE = 32 # max blocks queued for the writer thread
+BAM_THREADS = 4 # BGZF decompression threads used by pysam
+FLUSH_ROWS = 4096 # max rows held in memory before writing
+
+FILTERED_CIGAR_OPS = 'SDIHN' # clipping, indels & skipped regions
+
+_CIGAR_RE = re.compile('[' + FILTERED_CIGAR_OPS + ']').search
+_CIGAR_RE_BYTES = re.compile(('[' + FILTERED_CIGAR_OPS + ']').encode()).search
+_RNAME = itemgetter(2) # rname column of a read
+
+_rcache = dict()
+
+# Return a shared copy of a reference name, so repeated names compare and hash by identity
+def _intern_rname(s):
+    r = _rcache.get(s)
+    if r is None:
+        r = sys.intern(s)
+        _rcache[s] = r
+    return r
+
 class SamRead():
     def __init__(self, qname: str, flag: int, rname: str, pos: int, mapq: int, cigar: str,
                  rnext: str, pnext: int, tlen: int, seq: str, qual: str, whole_read: str, tags = None):
@@ -32,8 +62,8 @@ class SamRead():
         :param tlen: template length
         :param seq: segment (read) sequence
         :param qual: ASCII of Phred-scaled base quality +33
-        :param whole_read: whole row/read as string
-        :param tags: list of additional mapping data (see SAM manual)
+        :param whole_read: whole row/read as read from the input, including its newline
+        :param tags: list of additional mapping data (see SAM manual), or the raw tab-separated tag string
         """
         self.qname = qname
         self.flag = flag
@@ -49,20 +79,27 @@ class SamRead():
         self.whole_read = whole_read
 
         self.tags = tags # list
-        self.attr = dict()
+        self._attr = None # tag dict, parsed on first access
+
+    def _parse_tags(self):
+        self._attr = dict()
         if self.tags:
+            tags = self.tags.split('\t') if isinstance(self.tags, str) else self.tags
             for tag in tags:
-                tg = tag.split(':')
+                tg = tag.split(':', 2) # TAG:TYPE:VALUE, value may itself contain ':'
                 if tg[2].isnumeric():
-                    self.attr[tg[0]] = int(tg[2])
+                    self._attr[tg[0]] = int(tg[2])
                 else:
-                    self.attr[tg[0]] = tg[2]
+                    self._attr[tg[0]] = tg[2]
+        return self._attr
 
-    def __gettag__(self, tag):
-        return self.attr[tag]
+    def gettag(self, tag):
+        attr = self._attr if self._attr is not None else self._parse_tags()
+        return attr[tag]
 
     def __containstag__(self, tag):
-        return tag in self.attr
+        attr = self._attr if self._attr is not None else self._parse_tags()
+        return tag in attr
 
     def __strand__(self):
         if (self.tlen > 0) and (self.pos < self.pnext):
@@ -70,163 +107,281 @@ class SamRead():
         elif (self.tlen < 0) and (self.pos > self.pnext):
             return 'R2'
 
-def count_rname(item_rname: str, list_reads):
-    count = 0
-    for ls in list_reads:
-        if ls[2] == item_rname:
-            count += 1
-    return count
-
 # Remove duplicate pairs (adjacent rows) of reads
 def remove_dupl_list(list_reads):
-    pairs = []
+    seen = set()
     newlist = []
-    for i in range(len(list_reads)):
-        if i % 2 == 0:
-            pairs.append([list_reads[i], list_reads[i+1]])
-    for i in reversed(range(len(pairs))):
-        if pairs.count(pairs[i]) > 1:
-            del pairs[i]
-        elif pairs.count(pairs[i]) == 1:
-            rev_pair = [pairs[i][1], pairs[i][0]]
-            if pairs.count(rev_pair) >= 1:
-                del pairs[i]
-    for pair in pairs:
-        newlist.append(pair[0])
-        newlist.append(pair[1])
+    for i in range(0, len(list_reads), 2):
+        a, b = list_reads[i], list_reads[i+1]
+        # same key for a pair and its reversed duplicate
+        key = (a[2], min(a[3], b[3]), max(a[3], b[3]), abs(a[8]))
+        if key not in seen:
+            seen.add(key)
+            newlist.append(a)
+            newlist.append(b)
     return newlist
 
 # Sorts read pairs to be adjacent within each group of reads/qnames
-def sort_reads(list_reads, exceptions_out): 
+def sort_reads(list_reads):
     newlist = []
-    uniq = set()
+    groups = defaultdict(list)
     for ls in list_reads:
-        uniq.add(ls[2]) # determine unique rnames
-    for runiq in uniq:
-        runiq_list = []
-        for ls in list_reads:
-            if ls[2] == runiq:
-                runiq_list.append(ls)
+        groups[ls[2]].append(ls) # group reads by rname
+    for runiq_list in groups.values():
         if len(runiq_list) <= 1:
             continue
-        for i in range(len(runiq_list)):
-            for j in range(len(runiq_list)):
-                if i != j:
-                    if runiq_list[i][7] == runiq_list[j][3]: # mate pair = match pos of one read with pnext of another read
-                        if runiq_list[i][8] == -runiq_list[j][8]: # match tlen values (make one negative for mate pairs)
-                            newlist.append(runiq_list[i])
-                            newlist.append(runiq_list[j])
-    if len(newlist) % 2 == 0:
-        newlist = remove_dupl_list(newlist) # remove duplicate entries
-    elif len(newlist) % 2 != 0:
-        exceptions_out.write('Not an even number of reads for this qname: ' + list_reads[0][0])
-    return newlist
+        # index reads on (pos, tlen) so each mate is found with a single lookup
+        index = {(ls[3], ls[8]): i for i, ls in enumerate(runiq_list)}
+        find_mate = index.get
+        for i, ls in enumerate(runiq_list):
+            # mate pair = pos of mate matches pnext of read, and tlen values are opposite
+            j = find_mate((ls[7], -ls[8]))
+            if j is None or j == i:
+                continue
+            # a pair may be found from both reads, remove_dupl_list drops the second copy
+            if i < j:
+                newlist.append(ls)
+                newlist.append(runiq_list[j])
+            else:
+                newlist.append(runiq_list[j])
+                newlist.append(ls)
+    return remove_dupl_list(newlist) # remove duplicate entries
 
-def readSamFile(samfile, outfile, exceptionsout):
+def process_batch(reads):
     """
-    Read SAM file
-    :param filename: SAM file name
+    Pair and filter one batch of alignments sharing a qname
+    :param reads: list of reads with a common qname
+    :return: output rows as a list of bytes
+    """
+    # Sort batch of alignments with common qnames
+    reads.sort(key=_RNAME)  # sort by rname
+    # Then sort such that read pairs within each group of reads/qnames are also adjacent.
+    # Both reads of every pair share an rname, so each rname already occurs an even number of times.
+    return [ls[12] for ls in sort_reads(reads)]  # whole rows, newline included
+
+# Pass buffered rows to the writer thread as a single block once at least min_rows are held
+def flush_rows(write_queue, fd, buf, min_rows=1):
+    if buf and len(buf) >= min_rows:
+        write_queue.put((fd, b''.join(buf)))
+        buf.clear()
+
+# Writer stage: write (fd, bytes) blocks from write_queue until None is received.
+# A write error is stored in errors for the caller to raise, and later blocks are drained so put() never blocks
+def write_chunks(write_queue, errors):
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        fd, data = item
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(fd, view):]
+        except Exception as e:
+            errors.append(e)
+
+# Return the offset just past the SAM header, i.e. the start of the first row not beginning with '@'
+def find_header_end(mm):
+    at = ord('@')
+    end = len(mm)
+    pos = 0
+    while pos < end and mm[pos] == at:
+        nl = mm.find(b'\n', pos)
+        pos = end if nl < 0 else nl + 1
+    return pos
+
+# Yield the rows of a mapped file from offset start on, each ending in its newline
+def iter_rows(mm, start=0):
+    find = mm.find
+    end = len(mm)
+    while start < end:
+        nl = find(b'\n', start)
+        if nl < 0: # last row without a newline
+            yield mm[start:end] + b'\n'
+            break
+        yield mm[start:nl+1]
+        start = nl + 1
+
+# Apply the read filters to fields sliced out of the row, and only split rows that pass
+def _prefilter(row):
+    t1 = row.find(b'\t')
+    t2 = row.find(b'\t', t1 + 1)
+    t3 = row.find(b'\t', t2 + 1)
+    t4 = row.find(b'\t', t3 + 1)
+    t5 = row.find(b'\t', t4 + 1)
+    t6 = row.find(b'\t', t5 + 1)
+    t7 = row.find(b'\t', t6 + 1)
+    t8 = row.find(b'\t', t7 + 1)
+    t9 = row.find(b'\t', t8 + 1)
+    t10 = row.find(b'\t', t9 + 1)
+    # a failed find returns -1 and the next one restarts from 0, so offsets of a row with fewer
+    # than the 11 mandatory fields are not strictly increasing
+    if not -1 < t1 < t2 < t3 < t4 < t5 < t6 < t7 < t8 < t9 < t10:
+        raise IndexError('SAM row has fewer than 11 fields: ' + repr(row))
+    if row[t2+1:t3] == b'*': # rname
+        return None
+    if row[t6+1:t7] != b'=': # rnext
+        return None
+    if int(row[t8+1:t9]) == 0: # tlen, to avoid reads that may be in pairs but failed to align concordantly or discordantly
+        return None
+    if _CIGAR_RE_BYTES(row, t5 + 1, t6): # avoid clipping, indels & skipped regions
+        return None
+    # split off the fields used for pairing only, the rest of the row stays unsplit
+    return row.split(b'\t', 9)
+
+def iter_reads(rows):
+    """
+    Parse SAM alignment rows into reads, skipping filtered and empty rows
+    :param rows: iterable of SAM alignment rows as bytes (header already consumed)
+    :return: generator of reads
+    """
+    for row in rows:
+        if row == b'\n': # empty row
+            continue
+        try:
+            fields = _prefilter(row)
+            if fields is None:
+                continue
+            # int() parses bytes directly, only text fields are decoded
+            qname = fields[0].decode()
+            flag = int(fields[1])
+            rname = _intern_rname(fields[2].decode())
+            pos = int(fields[3])
+            mapq = int(fields[4])
+            pnext = int(fields[7])
+            tlen = int(fields[8])
+
+            # rnext is '=' after filtering; cigar, seq, qual and tags are only needed as part of the
+            # whole row, so they are not decoded (as for BAM input)
+            yield [qname, flag, rname, pos, mapq, None, '=', pnext, tlen, None, None, None, row]
+
+        except RuntimeError as e:
+            raise RuntimeError(row, e)
+
+def iter_bam_reads(alignments):
+    """
+    Convert BAM alignments into reads, skipping filtered alignments
+    :param alignments: iterable of pysam AlignedSegment records
+    :return: generator of reads
+    """
+    for aln in alignments:
+        if aln.reference_id < 0: # rname '*'
+            continue
+        if aln.next_reference_id != aln.reference_id: # rnext other than '='
+            continue
+        tlen = aln.template_length
+        if tlen == 0: # to avoid reads that may be in pairs but failed to align concordantly or discordantly
+            continue
+        cigar = aln.cigarstring or '*'
+        if _CIGAR_RE(cigar): # avoid clipping, indels & skipped regions
+            continue
+
+        # seq, qual and tags are only needed as part of the whole row, so they are not extracted
+        yield [aln.query_name, aln.flag, _intern_rname(aln.reference_name), aln.reference_start + 1,
+               aln.mapping_quality, cigar, '=', aln.next_reference_start + 1, tlen, None, None, None,
+               aln.to_string().encode() + b'\n']
+
+def iter_batches(reads):
+    """
+    Group reads into batches sharing a qname (input must be sorted by name)
+    :param reads: iterable of reads
+    :return: generator of read lists, one per qname with more than one read
+    """
+    current_qname = None
+    current_reads = []
+    for read in reads:
+        if read[0] == current_qname:
+            current_reads.append(read)
+        else:
+            # Hand previous batch of alignments with common qnames on for sorting
+            if len(current_reads) > 1:
+                yield current_reads
+            current_qname = read[0]
+            current_reads = [read]
+    if len(current_reads) > 1:
+        yield current_reads
+
+@contextmanager
+def open_batch_map(processes=1):
+    """
+    Provide a function mapping process_batch over batches of reads
+    :param processes: number of processes sorting qname batches (default: 1, i.e. in this process).
+    A pool only helps when sorting outweighs pickling every batch to the workers, since parsing stays in
+    this process; pooled output has qname batches in no fixed order
+    """
+    if processes <= 1:
+        yield partial(map, process_batch)
+    else:
+        # qname batches are independent, so sort them in worker processes and write in whatever order they finish
+        with multiprocessing.Pool(processes) as pool:
+            yield partial(pool.imap_unordered, process_batch, chunksize=64)
+
+def write_batches(batches, header, outfile, exceptionsout, batch_map):
+    """
+    Sort batches of reads and write the results
+    :param batches: iterable of read lists sharing a qname
+    :param header: SAM header as bytes, written before any reads
     :param outfile: sorted output file
-    :param exceptions_out: reads that were no successfully written to outfile
-    """
-    generate = (r for r in open(samfile, 'r'))
-    mmd = dict()
-    out_file = open(outfile, 'a+')
-    exceptions_out = open(exceptionsout, 'a+')
-    for row in generate:
-        if row.startswith('@'): # SAM header
-            out_file.write(row)
-        elif row == '\n': # for final empty row
-            if len(mmd.keys()) == 1:
-                qname_previous = list(mmd)[0] # convert mmd key to list and isolate first and only element
-                if len(mmd[qname_previous]) > 1:
-                    # Sort previous batch of alignments with common qnames
-                    mmd[qname_previous].sort(key=lambda x: x[2])  # sort by rname
-                    # Then sort such that read pairs within each group of reads/qnames are also adjacent
-                    sr = sort_reads(mmd[qname_previous], exceptions_out)
-                    mmd = {qname_previous: sr}
-                    # Check if there is an even number of occurrences of each rname in dict
-                    for ls in range(len(mmd[qname_previous])):
-                        # if rname count in list is even
-                        if count_rname(mmd[qname_previous][ls][2], mmd[qname_previous]) % 2 == 0:
-                            out_file.write(mmd[qname_previous][ls][12] + '\n')  # write whole row
-                        # if rname count in list not even
-                        elif count_rname(mmd[qname_previous][ls][2], mmd[qname_previous]) % 2 != 0:
-                            exceptions_out.write('Rname does not occur even number of times: '
-                                                 + mmd[qname_previous][ls][0] + '\t'  # qname
-                                                 + mmd[qname_previous][ls][2] + '\t'  # rname
-                                                 + mmd[qname_previous][ls][5] + '\n')  # cigar
-                            continue
+    :param exceptionsout: exceptions file, kept for command line compatibility and always created empty
+    :param batch_map: function mapping process_batch over batches, from open_batch_map
+    """
+    write_buf = []
+    write_errors = []
+    write_queue = queue.Queue(QUEUE_SIZE)
+    with open(outfile, 'wb', buffering=0) as out_file, open(exceptionsout, 'wb'):
+        out_fd = out_file.fileno()
+        # Writing runs on its own thread (file I/O releases the GIL) so it overlaps parsing
+        writer = threading.Thread(target=write_chunks, args=(write_queue, write_errors), daemon=True)
+        writer.start()
+        try:
+            if header:
+                write_queue.put((out_fd, header))
+
+            for out_rows in batch_map(batches):
+                if write_errors: # stop early, the error is raised below
+                    break
+                write_buf.extend(out_rows)
+                flush_rows(write_queue, out_fd, write_buf, FLUSH_ROWS)
             else:
-                exceptions_out.write('Length of mmd !=1 at ' + qname_previous)
-        else:
-            try:
-                fields = row.strip().split('\t')
-                qname = fields[0]
-                flag = int(fields[1])
-                rname = fields[2]
-                pos = int(fields[3])
-                mapq = int(fields[4])
-                cigar = fields[5]
-                rnext = fields[6]
-                pnext = int(fields[7])
-                tlen = int(fields[8])
-                seq = fields[9]
-                qual = fields[10]
-                tags = None
-                if len(fields) > 11: # if tags are present
-                    tags = []
-                    for field in fields[11:]:
-                        tags.append(field.strip('\n'))
-
-                if rname == '*':
-                    continue
-                if rnext != '=':
-                    continue
-                if tlen == 0: # to avoid reads that may be in pairs but failed to align concordantly or discordantly
-                    continue
-                if any(item in cigar for item in 'SDIHN'): # avoid clipping, indels & skipped regions
-                    continue
-
-                read = [qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, qual, tags, row.strip('\n')]
-                
-                # Alternatively can initialise a SamRead object
-                # read = SamRead(qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual,row.strip('\n'),tags)
-
-                if mmd == {}:
-                    mmd[qname] = [read]
-                elif mmd != {}:
-                    if len(mmd.keys()) == 1:
-                        if qname in mmd.keys():
-                            mmd[qname].append(read)
-                            qname_previous = qname
-                        elif qname not in mmd.keys():
-                            qkey = list(mmd)[0]
-                            if len(mmd[qkey]) > 1:
-                                # Sort previous batch of alignments with common qnames
-                                mmd[qname_previous].sort(key=lambda x: x[2])  # sort by rname
-                                # Then sort such that read pairs within each group of reads/qnames are also adjacent
-                                sr = sort_reads(mmd[qname_previous], exceptions_out)
-                                mmd = {qname_previous: sr}
-                                # Check if there is an even number of occurrences of each rname in dict
-                                for ls in range(len(mmd[qname_previous])):
-                                    # if rname count in list is even
-                                    if count_rname(mmd[qname_previous][ls][2], mmd[qname_previous]) % 2 == 0:
-                                        out_file.write(mmd[qname_previous][ls][12] + '\n') # write whole row
-                                    # if rname count in list not even
-                                    elif count_rname(mmd[qname_previous][ls][2], mmd[qname_previous]) % 2 != 0:
-                                        exceptions_out.write('Rname does not occur even number of times: '
-                                                             + mmd[qname_previous][ls][0] + '\t'  # qname
-                                                             + mmd[qname_previous][ls][2] + '\t'  # rname
-                                                             + mmd[qname_previous][ls][5] + '\n')  # cigar
-                                        continue
-                            # Start new dictionary with next batch of alignments
-                            mmd = {qname: [read]}
-                    else:
-                        exceptions_out.write('Length of mmd !=1 at ' + qname)
-
-            except RuntimeError as e:
-                raise RuntimeError(row, e)
-
-    out_file.close()
-    exceptions_out.close()
+                flush_rows(write_queue, out_fd, write_buf)
+        finally:
+            write_queue.put(None)
+            writer.join()
+        if write_errors:
+            raise write_errors[0]
+
+def readSamFile(samfile, outfile, exceptionsout, processes=1):
+    """
+    Read SAM file
+    :param samfile: SAM file name
+    :param outfile: sorted output file
+    :param exceptionsout: exceptions file, kept for command line compatibility and always created empty
+    :param processes: number of processes sorting qname batches, more than 1 uses a worker pool (default: 1)
+    """
+    # Any worker processes are forked here, before the writer thread exists, since forking a multi-threaded process can deadlock
+    with open_batch_map(processes) as batch_map, open(samfile, 'rb') as sam:
+        size = os.fstat(sam.fileno()).st_size
+        # an empty file cannot be mapped
+        with (mmap.mmap(sam.fileno(), 0, access=mmap.ACCESS_READ) if size else nullcontext(b'')) as mm:
+            # Rows are sliced from the mapping as bytes, leaving read-ahead to the OS and skipping text decoding
+            header_end = find_header_end(mm)
+            rows = iter_rows(mm, header_end)
+            write_batches(iter_batches(iter_reads(rows)), mm[:header_end], outfile, exceptionsout, batch_map)
+
+def readBamFile(bamfile, outfile, exceptionsout, processes=1):
+    """
+    Read BAM file (requires pysam)
+    :param bamfile: BAM file name
+    :param outfile: sorted output file
+    :param exceptionsout: exceptions file, kept for command line compatibility and always created empty
+    :param processes: number of processes sorting qname batches, more than 1 uses a worker pool (default: 1)
+    """
+    import pysam # optional dependency, only needed for BAM input
+
+    # Any worker processes are forked before pysam starts its threads, since forking a multi-threaded process can deadlock.
+    # pysam decompresses BGZF blocks on its own threads and exposes fields as integers, so no text parsing is needed
+    with open_batch_map(processes) as batch_map, \
+            pysam.AlignmentFile(bamfile, 'rb', threads=BAM_THREADS) as bam:
+        write_batches(iter_batches(iter_bam_reads(bam)), str(bam.header).encode(), outfile, exceptionsout, batch_map)